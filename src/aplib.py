@@ -7,134 +7,257 @@ Compatible with both Python 2 and 3.
 """
 import struct
 from binascii import crc32
-from io import BytesIO
 
 __all__ = ['APLib', 'decompress']
 __version__ = '0.6'
 __author__ = 'Sandor Nemes'
 
+# aPLib header fields following the 'AP32' tag
+_HEADER = struct.Struct('=IIIII')
+
+# zero bytes appended to the input, enough for any single token to read
+# past the end without raising, the overrun is detected before output
+_PADDING = b'\x00' * 8
+
+# largest output aPLib can describe, sizes are 32-bit in the format
+_MAX_SIZE = 0xffffffff
+
+# token types, each equal to the number of leading one bits in its tag prefix
+_LITERAL, _MATCH, _SHORT_MATCH, _SINGLE_BYTE = range(4)
+
+# token type and number of tag bits consumed, indexed by the next 3 tag bits
+_TOKENS = (
+    (_LITERAL, 1), (_LITERAL, 1), (_LITERAL, 1), (_LITERAL, 1),  # 0xx
+    (_MATCH, 2), (_MATCH, 2),                                    # 10x
+    (_SHORT_MATCH, 3),                                           # 110
+    (_SINGLE_BYTE, 3),                                           # 111
+)
+
+
+def _depack(source, destination, limit=_MAX_SIZE):
+    # all decoder state is kept in locals, the bit reader and the
+    # back-reference copy are inlined where they are used
+    src = bytearray(source)
+    src += _PADDING
+    dst = destination
+    append = dst.append
+
+    # back-references may not reach into what was in destination before
+    base = len(dst)
+
+    # reading beyond this position means the input is truncated
+    end = len(src) - len(_PADDING)
+    if not end:
+        return False
+
+    # tag holds the unread tag bits from bit 7 down, followed by a sentinel
+    # one bit, so it is empty when only the sentinel is left in bit 7
+    pos = 0
+    tag = 0x80
+    r0 = -1
+    lwm = 0
+
+    # first byte verbatim
+    append(src[pos])
+    pos += 1
+
+    # main decompression loop
+    while True:
+        if tag & 0x1f:
+            # at least 3 bits left, decode the token type with a single lookup
+            token, consumed = _TOKENS[tag >> 5]
+            tag = tag << consumed & 0xff
+        else:
+            # count leading one bits, at most 3
+            token = 0
+            while token < 3:
+                if tag == 0x80:
+                    # load next tag, the sentinel goes in behind its first bit
+                    tag = src[pos]
+                    pos += 1
+                    bit = tag & 0x80
+                    tag = (tag << 1 | 1) & 0xff
+                else:
+                    bit = tag & 0x80
+                    tag = tag << 1 & 0xff
+                if not bit:
+                    break
+                token += 1
+
+        if token == _LITERAL:
+            value = src[pos]
+            pos += 1
+            if pos > end:
+                return False
+
+            append(value)
+            lwm = 0
+        elif token == _MATCH:
+            # input gamma2-encoded offset
+            offs = 1
+            while True:
+                if tag == 0x80:
+                    tag = src[pos]
+                    pos += 1
+                    offs = (offs << 1) + (tag >> 7)
+                    tag = (tag << 1 | 1) & 0xff
+                else:
+                    offs = (offs << 1) + (tag >> 7)
+                    tag = tag << 1 & 0xff
+
+                if tag == 0x80:
+                    tag = src[pos]
+                    pos += 1
+                    more = tag & 0x80
+                    tag = (tag << 1 | 1) & 0xff
+                else:
+                    more = tag & 0x80
+                    tag = tag << 1 & 0xff
+
+                if not more:
+                    break
+
+            if lwm == 0 and offs == 2:
+                offs = r0
+                adjust = 0
+            else:
+                if lwm == 0:
+                    offs -= 3
+                else:
+                    offs -= 2
+
+                offs <<= 8
+                offs += src[pos]
+                pos += 1
+
+                # length bias for far and near offsets, computed without branches
+                adjust = (offs >= 32000) + (offs >= 1280) + 2 * (offs < 128)
+
+            # input gamma2-encoded length
+            length = 1
+            while True:
+                if tag == 0x80:
+                    tag = src[pos]
+                    pos += 1
+                    length = (length << 1) + (tag >> 7)
+                    tag = (tag << 1 | 1) & 0xff
+                else:
+                    length = (length << 1) + (tag >> 7)
+                    tag = tag << 1 & 0xff
+
+                if tag == 0x80:
+                    tag = src[pos]
+                    pos += 1
+                    more = tag & 0x80
+                    tag = (tag << 1 | 1) & 0xff
+                else:
+                    more = tag & 0x80
+                    tag = tag << 1 & 0xff
+
+                if not more:
+                    break
+
+            length += adjust
+
+            n = len(dst)
+            if pos > end or not 0 < offs <= n - base:
+                return False
+
+            # reject lengths from a corrupt stream before building the run
+            if length > limit - (n - base):
+                return False
+
+            start = n - offs
+            if offs >= length:
+                # source does not overlap the bytes being written, copy in bulk
+                dst += dst[start:start + length]
+            else:
+                # source overlaps the bytes being written, so the last offs
+                # bytes repeat, build the whole run at once
+                pattern = dst[start:]
+                dst += pattern * (length // offs) + pattern[:length % offs]
+
+            r0 = offs
+            lwm = 1
+        elif token == _SHORT_MATCH:
+            offs = src[pos]
+            pos += 1
+            length = 2 + (offs & 1)
+            offs >>= 1
+
+            if pos > end:
+                return False
+            if not offs:
+                return True
+
+            n = len(dst)
+            if offs > n - base:
+                return False
+
+            start = n - offs
+            if offs >= length:
+                dst += dst[start:start + length]
+            else:
+                pattern = dst[start:]
+                dst += pattern * (length // offs) + pattern[:length % offs]
+
+            r0 = offs
+            lwm = 1
+        else:
+            # read 4 bits of offset at once, loading next tag if needed
+            if tag & 0x0f:
+                offs = tag >> 4
+                tag = tag << 4 & 0xff
+            else:
+                # the sentinel position tells how many bits are left
+                bitcount = 8 - (tag & -tag).bit_length()
+                offs = tag >> 8 - bitcount
+                value = src[pos]
+                pos += 1
+                offs = offs << 4 - bitcount | value >> 4 + bitcount
+                tag = (value << 1 | 1) << 3 - bitcount & 0xff
+
+            if pos > end or offs > len(dst) - base:
+                return False
+
+            if offs:
+                append(dst[-offs])
+            else:
+                append(0)
+
+            lwm = 0
+
 
 class APLib(object):
 
-    __slots__ = 'source', 'destination', 'tag', 'bitcount', 'strict'
+    __slots__ = 'source', 'destination', 'strict'
 
     def __init__(self, source, strict=True):
-        self.source = BytesIO(source)
+        self.source = source
         self.destination = bytearray()
-        self.tag = 0
-        self.bitcount = 0
         self.strict = bool(strict)
 
-    def getbit(self):
-        # check if tag is empty
-        self.bitcount -= 1
-        if self.bitcount < 0:
-            # load next tag
-            self.tag = ord(self.source.read(1))
-            self.bitcount = 7
-
-        # shift bit out of tag
-        bit = self.tag >> 7 & 1
-        self.tag <<= 1
-
-        return bit
-
-    def getgamma(self):
-        result = 1
-
-        # input gamma2-encoded bits
-        while True:
-            result = (result << 1) + self.getbit()
-            if not self.getbit():
-                break
-
-        return result
-
     def depack(self):
-        r0 = -1
-        lwm = 0
-        done = False
-
-        try:
-
-            # first byte verbatim
-            self.destination += self.source.read(1)
-
-            # main decompression loop
-            while not done:
-                if self.getbit():
-                    if self.getbit():
-                        if self.getbit():
-                            offs = 0
-                            for _ in range(4):
-                                offs = (offs << 1) + self.getbit()
-
-                            if offs:
-                                self.destination.append(self.destination[-offs])
-                            else:
-                                self.destination.append(0)
-
-                            lwm = 0
-                        else:
-                            offs = ord(self.source.read(1))
-                            length = 2 + (offs & 1)
-                            offs >>= 1
-
-                            if offs:
-                                for _ in range(length):
-                                    self.destination.append(self.destination[-offs])
-                            else:
-                                done = True
-
-                            r0 = offs
-                            lwm = 1
-                    else:
-                        offs = self.getgamma()
-
-                        if lwm == 0 and offs == 2:
-                            offs = r0
-                            length = self.getgamma()
-
-                            for _ in range(length):
-                                self.destination.append(self.destination[-offs])
-                        else:
-                            if lwm == 0:
-                                offs -= 3
-                            else:
-                                offs -= 2
-
-                            offs <<= 8
-                            offs += ord(self.source.read(1))
-                            length = self.getgamma()
-
-                            if offs >= 32000:
-                                length += 1
-                            if offs >= 1280:
-                                length += 1
-                            if offs < 128:
-                                length += 2
-
-                            for _ in range(length):
-                                self.destination.append(self.destination[-offs])
-
-                            r0 = offs
-
-                        lwm = 1
-                else:
-                    self.destination += self.source.read(1)
-                    lwm = 0
+        # decode into a fresh buffer, so repeated calls give the same result
+        self.destination = bytearray()
+        self.depack_into(self.destination)
+        return bytes(self.destination)
 
-        except (TypeError, IndexError):
-            if self.strict:
-                raise RuntimeError('aPLib decompression error')
+    def depack_into(self, out, limit=_MAX_SIZE):
+        # append at most limit decompressed bytes to out and return their count
+        start = len(out)
+        if not _depack(self.source, out, limit) and self.strict:
+            # leave out as it was on failure
+            del out[start:]
+            raise RuntimeError('aPLib decompression error')
 
-        return bytes(self.destination)
+        return len(out) - start
 
     def pack(self):
         raise NotImplementedError
 
 
-def decompress(data, strict=False):
+def decompress(data, strict=False, out=None):
     packed_size = None
     packed_crc = None
     orig_size = None
@@ -142,7 +265,7 @@ def decompress(data, strict=False):
 
     if data.startswith(b'AP32') and len(data) >= 24:
         # data has an aPLib header
-        header_size, packed_size, packed_crc, orig_size, orig_crc = struct.unpack_from('=IIIII', data, 4)
+        header_size, packed_size, packed_crc, orig_size, orig_crc = _HEADER.unpack_from(data, 4)
         data = data[header_size : header_size + packed_size]
 
     if strict:
@@ -151,15 +274,25 @@ def decompress(data, strict=False):
         if packed_crc is not None and packed_crc != crc32(data):
             raise RuntimeError('Packed data checksum is incorrect')
 
-    result = APLib(data, strict=strict).depack()
+    # decompress into the caller's bytearray if given, avoiding a final copy
+    result = bytearray() if out is None else out
+    start = len(result)
+    # in strict mode the header size bounds the output, anything longer fails
+    limit = orig_size if strict and orig_size is not None else _MAX_SIZE
+    size = APLib(data, strict=strict).depack_into(result, limit)
 
     if strict:
-        if orig_size is not None and orig_size != len(result):
+        if orig_size is not None and orig_size != size:
+            del result[start:]
             raise RuntimeError('Unpacked data size is incorrect')
-        if orig_crc is not None and orig_crc != crc32(result):
+        if orig_crc is not None and orig_crc != crc32(memoryview(result)[start:]):
+            del result[start:]
             raise RuntimeError('Unpacked data checksum is incorrect')
 
-    return result
+    if out is None:
+        return bytes(result)
+
+    return size
 
 
 def main():
@@ -167,6 +300,11 @@ def main():
     data = b'T\x00he quick\xecb\x0erown\xcef\xaex\x80jumps\xed\xe4veur`t?lazy\xead\xfeg\xc0\x00'
     assert decompress(data) == b'The quick brown fox jumps over the lazy dog'
 
+    # decompress into a caller-provided buffer, appending after its contents
+    out = bytearray(b'>>')
+    assert decompress(data, out=out) == 43
+    assert out == b'>>The quick brown fox jumps over the lazy dog'
+
 
 if __name__ == '__main__':
     main()